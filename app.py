@@ -1,9 +1,18 @@
+import io
 import os
-import requests
-from typing import Tuple
-
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Iterator, Tuple
+
+import httpx
+import jiter
+import orjson
 import streamlit as st
-from openai import OpenAI
+import tiktoken
+from openai import ContentFilterFinishReasonError, LengthFinishReasonError, OpenAI
+from pydantic import BaseModel, Field
 
 
 SECTION_TITLES = [
@@ -15,23 +24,38 @@ SECTION_TITLES = [
     "6. Future Directions",
 ]
 
+_TITLES_RE = re.compile("|".join(re.escape(t) for t in SECTION_TITLES))
+# A section heading the model repeated at the start of its own field, optionally with markdown emphasis.
+_LEADING_TITLE_RES = [re.compile(rf"^\s*[#*]*\s*{re.escape(t)}[*:]*\s*") for t in SECTION_TITLES]
+
 SEMANTIC_SCHOLAR_SEARCH_URL = "https://api.semanticscholar.org/graph/v1/paper/search"
 
+# The six mandatory JSON sections need roughly this many output tokens however short the prompt is.
+MIN_OUTPUT_TOKENS = 1200
+MAX_OUTPUT_TOKENS = 2200
 
-def semantic_scholar_search(query: str, limit: int = 8) -> str:
+
+@st.cache_resource
+def _http() -> httpx.Client:
+    # Shared across reruns so the TLS connection to Semantic Scholar is reused.
+    return httpx.Client(timeout=20, transport=httpx.HTTPTransport(http2=True, retries=2))
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def fetch_papers(query: str, limit: int) -> list:
     params = {
         "query": query,
         "limit": limit,
-        "fields": "title,abstract,authors,year,journal,isOpenAccess,url"
+        "fields": "title,abstract,authors,year,journal,isOpenAccess,url",
+        # Server-side filter to papers with a public PDF; _format_records still checks isOpenAccess.
+        "openAccessPdf": "",
     }
-    try:
-        r = requests.get(SEMANTIC_SCHOLAR_SEARCH_URL, params=params, timeout=20)
-        r.raise_for_status()
-        data = r.json().get("data", [])
-    except Exception as e:
-        return f"[Literature search failed: {e}]"
+    r = _http().get(SEMANTIC_SCHOLAR_SEARCH_URL, params=params)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("data", [])
 
-    records = []
+
+def _format_records(data: list) -> Iterator[str]:
     for p in data:
         if not p.get("isOpenAccess"):
             continue
@@ -41,52 +65,139 @@ def semantic_scholar_search(query: str, limit: int = 8) -> str:
         authors = ", ".join(a.get("name") for a in p.get("authors", [])[:5])
         abstract = p.get("abstract", "Insufficient information provided.")
         url = p.get("url", "")
-        records.append(
-            f"Title: {title}\nAuthors: {authors}\nYear: {year}\nJournal: {journal}\nURL: {url}\nAbstract: {abstract}"
-        )
+        yield f"Title: {title}\nAuthors: {authors}\nYear: {year}\nJournal: {journal}\nURL: {url}\nAbstract: {abstract}"
 
-    return "\n\n---\n\n".join(records) if records else "Insufficient information provided."
+
+def semantic_scholar_search(query: str, limit: int = 8) -> str:
+    try:
+        data = fetch_papers(query, limit)
+    except Exception as e:
+        return f"[Literature search failed: {e}]"
+
+    buf = io.StringIO()
+    for record in _format_records(data):
+        if buf.tell():
+            buf.write("\n\n---\n\n")
+        buf.write(record)
+
+    return buf.getvalue() or "Insufficient information provided."
 
 
 def validate_section_order(text: str) -> Tuple[bool, str]:
     if not text or not text.strip():
         return False, "Empty response."
 
-    positions = []
+    hits = [m.group(0) for m in _TITLES_RE.finditer(text)]
+
     for title in SECTION_TITLES:
-        idx = text.find(title)
-        if idx == -1:
+        count = hits.count(title)
+        if count == 0:
             return False, f"Missing required section title: {title}"
-        positions.append(idx)
+        if count > 1:
+            return False, f"Duplicate section title: {title}"
 
-    if positions != sorted(positions):
+    if hits != SECTION_TITLES:
         return False, "Section titles are present but not in the required order."
 
     return True, "OK"
 
 
-SYSTEM_PROMPT = """You are a Research Assistant AI designed to support academic researchers.
-Your role is to organize, summarize, and structure research content without inventing facts, data, citations, or interpretations.
-
-ALLOWED SOURCE:
-- Open-access literature retrieved via Semantic Scholar search results provided below
+SYSTEM_PROMPT = """You are a Research Assistant for academic researchers. Organize, summarize, and structure the open-access Semantic Scholar records provided, without inventing facts, data, citations, or interpretations. They are your only source.
 
 STRICT PROHIBITIONS:
 - No fabricated citations
 - No inferred experimental results
 - No claims beyond provided abstracts
 
-OUTPUT FORMAT (MANDATORY):
-
-1. Structured Research Summary
-2. Key Gaps
-3. Methods
-4. Related Work
-5. APA References
-6. Future Directions
+Fill every section of the response schema. Do not repeat section headings inside the sections.
 """
 
 
+class ResearchOutput(BaseModel):
+    structured_research_summary: str = Field(description="Structured summary of the provided records.")
+    key_gaps: str = Field(description="Gaps stated or directly evidenced in the records.")
+    methods: str = Field(description="Methods reported in the records.")
+    related_work: str = Field(description="How the records relate to one another.")
+    apa_references: str = Field(description="APA references for the provided records only.")
+    future_directions: str = Field(description="Future directions stated in the records.")
+
+
+def format_output(sections: dict) -> str:
+    """Join section values under their numbered titles, skipping fields not yet streamed."""
+    return "\n\n".join(
+        f"{title}\n{heading_re.sub('', sections[name], count=1)}"
+        for title, heading_re, name in zip(SECTION_TITLES, _LEADING_TITLE_RES, ResearchOutput.model_fields)
+        if name in sections
+    )
+
+
+def stream_completion(client: OpenAI, placeholder, flush_every: int = 16, flush_interval: float = 0.05, **kwargs):
+    """Stream a ResearchOutput completion into a Streamlit placeholder and return the final message.
+
+    Partial sections, including the one still being written, are redrawn every
+    ``flush_every`` chunks or ``flush_interval`` seconds, whichever comes first,
+    and only when the rendered text has changed.
+    """
+    pending = 0
+    last_flush = time.monotonic()
+    rendered = ""
+    with client.chat.completions.stream(response_format=ResearchOutput, **kwargs) as stream:
+        for event in stream:
+            if event.type != "content.delta":
+                continue
+            pending += 1
+            now = time.monotonic()
+            if pending < flush_every and now - last_flush < flush_interval:
+                continue
+            pending = 0
+            last_flush = now
+            # event.parsed drops the unterminated trailing string; keep it so text appears as it is written.
+            partial = jiter.from_json(event.snapshot.encode(), partial_mode="trailing-strings")
+            text = format_output(partial) if isinstance(partial, dict) else ""
+            if text != rendered:
+                placeholder.markdown(text)
+                rendered = text
+        completion = stream.get_final_completion()
+    return completion.choices[0].message
+
+
+def _load_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@st.cache_resource(max_entries=8, ttl=600)
+def _encoding(model: str) -> Future:
+    """Load the tokenizer on a daemon thread, at most once per model every ten minutes.
+
+    The first load downloads BPE data without a timeout, so it must not run on the
+    click path. The ttl lets a failed load be retried instead of being cached for good.
+    """
+    future: Future = Future()
+
+    def load() -> None:
+        try:
+            future.set_result(_load_encoding(model))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=load, daemon=True).start()
+    return future
+
+
+def output_token_budget(model: str, user_prompt: str, user_cap: int) -> int:
+    """Scale max_tokens with the prompt size, bounded by the sidebar cap."""
+    encoding = _encoding(model)
+    if encoding.done() and encoding.exception() is None:
+        in_toks = len(encoding.result().encode(user_prompt))
+    else:
+        # Tokenizer still loading or unavailable (e.g. offline); approximate at ~4 characters per token.
+        in_toks = len(user_prompt) // 4
+    return min(user_cap, max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, in_toks // 2 + 400)))
+
+
 def build_user_prompt(topic: str, literature_block: str) -> str:
     return f"""TASK:
 Using ONLY the open-access literature records provided below, produce the required output.
@@ -104,6 +215,10 @@ st.title("Research Assistant AI — Open‑Access Literature Mode")
 
 api_key = st.sidebar.text_input("OPENAI_API_KEY", type="password", value=os.getenv("OPENAI_API_KEY", ""))
 model = st.sidebar.text_input("Model", value=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+_encoding(model)  # start loading the tokenizer before the first click
+max_output_tokens = st.sidebar.slider(
+    "Max output tokens", MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS, step=100
+)
 
 topic = st.text_input("Research topic", placeholder="e.g., inorganic passivation in perovskite solar cells")
 search_limit = st.slider("Number of open‑access papers", 3, 15, 8)
@@ -113,26 +228,45 @@ if st.button("Search & Generate"):
         st.error("Missing OPENAI_API_KEY")
         st.stop()
 
+    topic = topic.strip()
+    if not topic:
+        st.error("Missing research topic")
+        st.stop()
+
     with st.spinner("Searching open‑access literature..."):
         literature_block = semantic_scholar_search(topic, search_limit)
 
     user_prompt = build_user_prompt(topic, literature_block)
 
     client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model=model,
-        temperature=0.2,
-        max_tokens=2200,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt},
-        ],
-    )
+    placeholder = st.empty()
+    try:
+        message = stream_completion(
+            client,
+            placeholder,
+            model=model,
+            temperature=0.2,
+            max_tokens=output_token_budget(model, user_prompt, max_output_tokens),
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+        )
+    except LengthFinishReasonError:
+        st.error("The response hit the output token limit before all sections were written.")
+        st.stop()
+    except ContentFilterFinishReasonError:
+        st.error("The response was stopped by the content filter.")
+        st.stop()
+
+    if message.parsed is None:
+        st.error(f"The model declined to answer: {message.refusal}")
+        st.stop()
 
-    output = response.choices[0].message.content
+    output = format_output(message.parsed.model_dump())
     ok, reason = validate_section_order(output)
 
-    st.text_area("Structured Output", output, height=520)
+    placeholder.text_area("Structured Output", output, height=520)
     st.caption(f"Format check: {reason}")
 
     with st.expander("Open‑Access Papers Retrieved"):